@@ -1,15 +1,28 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import googleapiclient.discovery
+import googleapiclient.discovery_cache
 import googleapiclient.errors
+import googleapiclient.model
 import os
+import re
+import html
 import json
-from datetime import datetime, timedelta
-import requests
-from PIL import Image
-from io import BytesIO
+import threading
+import time
+import functools
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from dotenv import load_dotenv
-import base64
-import pickle
+import diskcache
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Load environment variables
 load_dotenv()
@@ -19,6 +32,38 @@ API_SERVICE_NAME = "youtube"
 API_VERSION = "v3"
 SCOPES = ["https://www.googleapis.com/auth/youtube.force-ssl"]
 
+# Video grid layout (pixels). The component's iframe height is fixed when it
+# is rendered and can't follow the browser's column width, so it is sized
+# from the row count with an estimated row height and scrolls if rows run taller.
+PLAYER_HEIGHT = 315
+PLAYER_MARGIN = 16
+GRID_ROW_HEIGHT = 290
+MAX_GRID_HEIGHT = 20000
+
+# Number of concurrent YouTube API requests per refresh
+MAX_WORKERS = 8
+
+VIDEO_CACHE_TTL = 86400  # Cached videos are fresh for 24 hours
+VIDEO_CACHE_RETENTION = 30 * 86400  # Stale copies are kept as a fallback when the API is unavailable
+REFRESH_MAX_AGE = 3600  # "Refresh Videos" only refetches entries older than 1 hour
+REFRESH_KEY = 'refresh_requested_at'
+
+# Persistent video cache, survives app restarts to save API quota
+@st.cache_resource(show_spinner=False)
+def get_video_cache():
+    return diskcache.Cache('.yt_cache')
+
+# JSON helpers: use orjson when available, falling back to the stdlib
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode('utf-8')
+
 # Load configuration
 def load_config():
     default_config = {
@@ -27,51 +72,183 @@ def load_config():
         "channel_ids": {}  # New field to store channel IDs
     }
     try:
-        with open('config.json', 'r') as config_file:
-            config = json.load(config_file)
+        with open('config.json', 'rb') as config_file:
+            config = json_loads(config_file.read())
             # Ensure the new field exists
             if 'channel_ids' not in config:
                 config['channel_ids'] = {}
             return config
     except FileNotFoundError:
-        with open('config.json', 'w') as config_file:
-            json.dump(default_config, config_file)
+        with open('config.json', 'wb') as config_file:
+            config_file.write(json_dumps(default_config))
         return default_config
 
-config = load_config()
+# Streamlit re-executes this script on every rerun; only re-parse
+# config.json when its modification time changes
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_config_cached(mtime):
+    return load_config()
+
+def get_config():
+    try:
+        mtime = os.path.getmtime('config.json')
+    except FileNotFoundError:
+        mtime = None
+    return load_config_cached(mtime)
+
+config = get_config()
+
+# Guards config.json against concurrent writes from worker threads and sessions
+@st.cache_resource(show_spinner=False)
+def get_config_lock():
+    return threading.Lock()
+
+# Set when config changes in memory; flushed to disk once per batch
+config_dirty = False
 
 # Save configuration
 def save_config():
-    with open('config.json', 'w') as config_file:
-        json.dump(config, config_file)
+    global config_dirty
+    with get_config_lock():
+        with open('config.json', 'wb') as config_file:
+            config_file.write(json_dumps(config))
+        config_dirty = False
+
+def save_config_if_dirty():
+    if config_dirty:
+        save_config()
+
+# Deserialize API responses with orjson instead of the stdlib json module
+class FastJsonModel(googleapiclient.model.JsonModel):
+    def deserialize(self, content):
+        try:
+            body = json_loads(content)
+        except ValueError:
+            return content
+        if self._data_wrapper and 'data' in body:
+            body = body['data']
+        return body
+
+# Read the bundled discovery document once per process, not once per client
+@st.cache_resource(show_spinner=False)
+def get_discovery_document():
+    return googleapiclient.discovery_cache.get_static_doc(API_SERVICE_NAME, API_VERSION)
 
 # Authenticate and create YouTube API client
 def get_authenticated_service():
-    return googleapiclient.discovery.build(
-        API_SERVICE_NAME, API_VERSION, developerKey=os.getenv('YOUTUBE_API_KEY'))
+    return googleapiclient.discovery.build_from_document(
+        get_discovery_document(), developerKey=os.getenv('YOUTUBE_API_KEY'), model=FastJsonModel())
+
+# googleapiclient is not thread-safe, so each thread gets its own client.
+# Cached as a resource so clients outlive Streamlit's script reruns.
+@st.cache_resource(show_spinner=False)
+def get_thread_local():
+    return threading.local()
+
+def get_youtube():
+    thread_local = get_thread_local()
+    if not hasattr(thread_local, 'youtube'):
+        thread_local.youtube = get_authenticated_service()
+    return thread_local.youtube
+
+# Long-lived worker pool: threads keep their clients, and with them their
+# open HTTPS connections, across refreshes instead of reconnecting each time
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+def run_in_pool(func, items):
+    # Worker threads need the script context to report errors to the page
+    ctx = get_script_run_ctx()
+
+    def task(item):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(item)
+
+    return list(get_executor().map(task, items))
+
+# Retry transient server errors with exponential backoff
+def is_transient_error(e):
+    return isinstance(e, googleapiclient.errors.HttpError) and e.resp.status in (500, 503)
 
-youtube = get_authenticated_service()
+@retry(retry=retry_if_exception(is_transient_error), wait=wait_exponential(multiplier=1, max=10),
+       stop=stop_after_attempt(3), reraise=True)
+def execute_request(request):
+    return request.execute()
+
+# Circuit breaker: once the API quota is exhausted, skip the API for
+# QUOTA_COOLDOWN seconds across all reruns and sessions, serving cached videos
+QUOTA_COOLDOWN = 900
+
+@st.cache_resource(show_spinner=False)
+def get_quota_state():
+    # 'generation' changes whenever the breaker trips or resets, so feeds
+    # cached under a different breaker state are not reused
+    return {'lock': threading.Lock(), 'tripped_at': None, 'error': None, 'generation': 0}
+
+def is_quota_error(e):
+    return e.resp.status == 429 or (e.resp.status == 403 and 'quotaExceeded' in str(e))
+
+def quota_tripped():
+    tripped_at = get_quota_state()['tripped_at']
+    return tripped_at is not None and time.time() - tripped_at < QUOTA_COOLDOWN
+
+def trip_quota_breaker(e):
+    state = get_quota_state()
+    with state['lock']:
+        if quota_tripped():
+            return
+        state['tripped_at'] = time.time()
+        state['error'] = str(e)
+        state['generation'] += 1
+
+# Current breaker generation, resetting the breaker once its cooldown ends
+def quota_generation():
+    state = get_quota_state()
+    with state['lock']:
+        if state['tripped_at'] is not None and not quota_tripped():
+            state['tripped_at'] = None
+            state['generation'] += 1
+        return state['generation']
 
 # Function to get channel ID from channel URL
 def get_channel_id(channel_url):
+    global config_dirty
     # Check if we have the channel ID cached
     if channel_url in config['channel_ids']:
         return config['channel_ids'][channel_url]
+    if quota_tripped():
+        return None
 
     try:
-        if '/channel/' in channel_url:
-            channel_id = channel_url.split('/channel/')[1]
-        elif '/user/' in channel_url or '/c/' in channel_url or '@' in channel_url:
-            username = channel_url.split('/')[-1]
-            if username.startswith('@'):
-                username = username[1:]  # Remove '@' if present
-            request = youtube.search().list(
+        # Ignore query strings and tab suffixes such as /videos or /featured
+        url_path = channel_url.split('?')[0].rstrip('/')
+        handle = next((segment for segment in url_path.split('/') if segment.startswith('@')), None)
+        if '/channel/' in url_path:
+            channel_id = url_path.split('/channel/')[1].split('/')[0]
+        elif handle or '/user/' in url_path:
+            # channels.list returns just the ID for 1 quota unit, no page scraping
+            if handle:
+                request = get_youtube().channels().list(part="id", forHandle=handle, fields="items/id")
+            else:
+                username = url_path.split('/user/')[1].split('/')[0]
+                request = get_youtube().channels().list(part="id", forUsername=username, fields="items/id")
+            response = execute_request(request)
+            if response.get('items'):
+                channel_id = response['items'][0]['id']
+            else:
+                st.error(f"Could not get channel ID for URL: {channel_url}")
+                return None
+        elif '/c/' in url_path:
+            # Custom URLs have no direct lookup, so fall back to search
+            username = url_path.split('/c/')[1].split('/')[0]
+            request = get_youtube().search().list(
                 part="snippet",
                 type="channel",
                 q=username,
                 maxResults=1
             )
-            response = request.execute()
+            response = execute_request(request)
             if response['items']:
                 channel_id = response['items'][0]['snippet']['channelId']
             else:
@@ -81,50 +258,204 @@ def get_channel_id(channel_url):
             st.error(f"Invalid channel URL format: {channel_url}")
             return None
 
-        # Cache the channel ID
+        # Cache the channel ID; the caller writes config.json once for the batch
         config['channel_ids'][channel_url] = channel_id
-        save_config()
+        config_dirty = True
         return channel_id
+    except googleapiclient.errors.HttpError as e:
+        if is_quota_error(e):
+            trip_quota_breaker(e)
+        else:
+            st.error(f"An error occurred while getting channel ID: {e}")
+        return None
     except Exception as e:
         st.error(f"An error occurred while getting channel ID: {e}")
         return None
 
+# Oldest fetch time still considered fresh: 24 hours ago, or 1 hour before
+# the last "Refresh Videos" click
+def fresh_after(video_cache):
+    cutoff = time.time() - VIDEO_CACHE_TTL
+    refreshed_at = video_cache.get(REFRESH_KEY)
+    if refreshed_at is not None:
+        cutoff = max(cutoff, refreshed_at - REFRESH_MAX_AGE)
+    return cutoff
+
+# Cache fetched videos on disk, keyed by channel and result count. Fresh
+# entries skip the API; stale ones are kept and served if the fetch fails.
+def disk_cached(func):
+    @functools.wraps(func)
+    def wrapper(channel_id, max_results=10):
+        key = f"{channel_id}:{max_results}"
+        video_cache = get_video_cache()
+        cached = video_cache.get(key)
+        if cached is not None and cached[0] >= fresh_after(video_cache):
+            return cached[1]
+        items = func(channel_id, max_results)
+        # Don't cache failed fetches; fall back to the last stored copy
+        if items:
+            video_cache.set(key, (time.time(), items), expire=VIDEO_CACHE_RETENTION)
+        elif cached is not None:
+            return cached[1]
+        return items
+    return wrapper
+
+# Mark entries older than REFRESH_MAX_AGE as stale without deleting them
+def request_video_refresh():
+    get_video_cache().set(REFRESH_KEY, time.time())
+
+# Only request the playlist item fields the app uses
+PLAYLIST_ITEM_FIELDS = (
+    "items("
+    "snippet(title,description,publishedAt,thumbnails/medium),"
+    "contentDetails(videoId,videoPublishedAt))"
+)
+
+# Convert an uploads playlist item to the search result shape the UI expects
+def playlist_item_to_video(item):
+    snippet = dict(item['snippet'])
+    # The playlist snippet's publishedAt is when the video was added to the playlist
+    snippet['publishedAt'] = item['contentDetails'].get('videoPublishedAt', snippet['publishedAt'])
+    return {
+        'id': {'videoId': item['contentDetails']['videoId']},
+        'snippet': snippet
+    }
+
 # Function to fetch latest videos from a channel
+@disk_cached
 def fetch_latest_videos(channel_id, max_results=10):
+    if quota_tripped():
+        return []
     try:
-        request = youtube.search().list(
-            part="snippet",
-            channelId=channel_id,
-            order="date",
-            type="video",
-            maxResults=max_results
+        # Every channel's uploads playlist is its ID with "UC" replaced by "UU".
+        # playlistItems.list costs 1 quota unit versus 100 for search.list.
+        uploads_playlist = 'UU' + channel_id[2:]
+        request = get_youtube().playlistItems().list(
+            part="snippet,contentDetails",
+            playlistId=uploads_playlist,
+            maxResults=max_results,
+            fields=PLAYLIST_ITEM_FIELDS
         )
-        response = request.execute()
-        return response['items']
+        response = execute_request(request)
+        return [playlist_item_to_video(item) for item in response['items']]
     except googleapiclient.errors.HttpError as e:
-        st.error(f"An error occurred: {e}")
+        if is_quota_error(e):
+            trip_quota_breaker(e)
+        else:
+            st.error(f"An error occurred: {e}")
         return []
 
+# Compile lowercased keywords into a single alternation (re caches the result)
+def compile_keywords(keywords):
+    return re.compile('|'.join(re.escape(keyword.lower()) for keyword in keywords))
+
+# Precompute per-video search text and sort key once per fetch
+def prepare_video(video):
+    video['_lc_text'] = (video['snippet']['title'] + '\n' + video['snippet']['description']).lower()
+    # Compare real instants rather than ISO 8601 strings, which only sort
+    # correctly when every timestamp uses the same UTC offset
+    video['_published_ts'] = datetime.fromisoformat(video['snippet']['publishedAt'].replace('Z', '+00:00')).timestamp()
+    return video
+
 # Function to filter relevant content
 def filter_relevant_content(videos, keywords):
-    return [video for video in videos if any(keyword.lower() in video['snippet']['title'].lower() or 
-                                             keyword.lower() in video['snippet']['description'].lower() 
-                                             for keyword in keywords)]
+    if not keywords:
+        return videos
+    pattern = compile_keywords(keywords)
+    return [video for video in videos if pattern.search(video['_lc_text'])]
+
+# Sort key: the video's publish time as a POSIX timestamp
+def published_at(video):
+    return video['_published_ts']
 
 # Cache videos
+# generation is only part of the cache key: a feed fetched while the quota
+# breaker was tripped (or that tripped it) isn't reused once it resets
 @st.cache_data(ttl=86400)  # Cache for 24 hours
-def get_cached_videos(channels, max_results=5, keywords=None):
-    all_videos = []
+def get_cached_videos(channels, max_results=5, generation=0):
+    channel_ids = {channel: config['channel_ids'][channel] for channel in channels if channel in config['channel_ids']}
+    uncached = [channel for channel in channels if channel not in channel_ids]
+
+    channel_ids.update(zip(uncached, run_in_pool(get_channel_id, uncached)))
+    save_config_if_dirty()
+
+    ids = []
     for channel in channels:
-        channel_id = get_channel_id(channel)
-        if channel_id:
-            videos = fetch_latest_videos(channel_id, max_results)
-            if keywords:
-                videos = filter_relevant_content(videos, keywords)
-            all_videos.extend(videos)
-        else:
+        if channel_ids[channel]:
+            # Different URLs can point at the same channel; fetch it only once
+            if channel_ids[channel] not in ids:
+                ids.append(channel_ids[channel])
+        elif not quota_tripped():
             st.warning(f"Skipping channel: {channel} - Could not get channel ID")
-    return sorted(all_videos, key=lambda x: x['snippet']['publishedAt'], reverse=True)
+
+    # Each channel's list is already (nearly) newest-first, so sorting it is
+    # cheap and the lists can be merged instead of re-sorting everything
+    channel_results = []
+    for videos in run_in_pool(lambda channel_id: fetch_latest_videos(channel_id, max_results), ids):
+        videos = [prepare_video(video) for video in videos]
+        channel_results.append(sorted(videos, key=published_at, reverse=True))
+
+    # Drop duplicate videos, keeping the first occurrence in the merged order
+    seen = set()
+    all_videos = []
+    for video in heapq.merge(*channel_results, key=published_at, reverse=True):
+        video_id = video['id']['videoId']
+        if video_id not in seen:
+            seen.add(video_id)
+            all_videos.append(video)
+    return all_videos
+
+# Render the player and thumbnail grid as one HTML component. Clicking a
+# thumbnail swaps the player's src in the browser, so playing a video
+# doesn't trigger a Streamlit rerun.
+def render_video_grid(videos):
+    if not videos:
+        return
+    cards = []
+    for video in videos:
+        video_id = html.escape(video['id']['videoId'])
+        thumbnail_url = html.escape(video['snippet']['thumbnails']['medium']['url'])
+        title = video['snippet']['title']
+        short_title = html.escape(f"{title[:50]}{'...' if len(title) > 50 else ''}")
+        cards.append(f'''
+            <a class="card" href="#" data-src="https://www.youtube.com/embed/{video_id}?autoplay=1" onclick="play(this); return false;">
+                <img src="{thumbnail_url}" alt="{html.escape(title)}" width="320" height="180" loading="lazy" decoding="async">
+                <strong>{short_title}</strong>
+                <span>Published: {html.escape(video['snippet']['publishedAt'][:10])}</span>
+            </a>''')
+
+    rows = (len(videos) + 2) // 3
+    components.html(f'''
+        <style>
+            body {{ margin: 0; font-family: "Source Sans Pro", sans-serif; }}
+            #player-area {{ height: {PLAYER_HEIGHT}px; margin-bottom: {PLAYER_MARGIN}px;
+                            display: flex; align-items: center; justify-content: center; background: #f0f2f6; color: #808495; }}
+            #player {{ display: none; width: 100%; height: 100%; border: 0; }}
+            .grid {{ display: grid; grid-template-columns: repeat(3, 1fr); gap: 1rem; }}
+            .card {{ display: flex; flex-direction: column; gap: 0.25rem; color: inherit; text-decoration: none; }}
+            .card img {{ width: 100%; height: auto; }}
+        </style>
+        <div id="player-area">
+            <span id="player-hint">Click a thumbnail to play</span>
+            <iframe id="player" allow="autoplay; encrypted-media" allowfullscreen></iframe>
+        </div>
+        <div class="grid">{''.join(cards)}</div>
+        <script>
+            function play(card) {{
+                const player = document.getElementById('player');
+                player.src = card.dataset.src;
+                player.style.display = 'block';
+                document.getElementById('player-hint').style.display = 'none';
+            }}
+        </script>
+    ''', height=min(PLAYER_HEIGHT + PLAYER_MARGIN + rows * GRID_ROW_HEIGHT, MAX_GRID_HEIGHT), scrolling=True)
+
+# Parse the sidebar inputs only when they change, not on every rerun
+def parse_channels():
+    st.session_state.channels_parsed = [channel.strip() for channel in st.session_state.channels_raw.split('\n') if channel.strip()]
+
+def parse_keywords():
+    st.session_state.keywords_parsed = [keyword.strip() for keyword in st.session_state.keywords_raw.split(',') if keyword.strip()]
 
 # Streamlit app
 def main():
@@ -133,47 +464,37 @@ def main():
 
     # Sidebar for configuration
     st.sidebar.header("Configuration")
-    channels = st.sidebar.text_area("Enter YouTube channel URLs (one per line)", value="\n".join(config['channels']))
-    channels = [channel.strip() for channel in channels.split('\n') if channel.strip()]
-    
-    keywords = st.sidebar.text_input("Enter keywords for filtering (comma-separated)", value=",".join(config['keywords']))
-    keywords = [keyword.strip() for keyword in keywords.split(',') if keyword.strip()]
+    if 'channels_raw' not in st.session_state:
+        st.session_state.channels_raw = "\n".join(config['channels'])
+        st.session_state.keywords_raw = ",".join(config['keywords'])
+        parse_channels()
+        parse_keywords()
+
+    st.sidebar.text_area("Enter YouTube channel URLs (one per line)", key="channels_raw", on_change=parse_channels)
+    st.sidebar.text_input("Enter keywords for filtering (comma-separated)", key="keywords_raw", on_change=parse_keywords)
+    channels = st.session_state.channels_parsed
+    keywords = st.session_state.keywords_parsed
 
     max_results = 1
 
     if st.sidebar.button("Save Configuration"):
-        config['channels'] = channels
-        config['keywords'] = keywords
-        with open('config.json', 'w') as config_file:
-            json.dump(config, config_file)
+        config['channels'] = list(channels)
+        config['keywords'] = list(keywords)
+        save_config()
         st.sidebar.success("Configuration saved!")
 
     # Main content
     if st.button("Refresh Videos"):
+        request_video_refresh()
         st.cache_data.clear()
         st.experimental_rerun()
 
-    videos = get_cached_videos(channels, max_results, keywords)
-
-    # Create a placeholder for the video player
-    video_placeholder = st.empty()
-
-    # Display videos in a grid
-    for i in range(0, len(videos), 3):
-        cols = st.columns(3)
-        for j in range(3):
-            if i + j < len(videos):
-                video = videos[i + j]
-                with cols[j]:
-                    with st.container():
-                        thumbnail_url = video['snippet']['thumbnails']['medium']['url']
-                        st.image(thumbnail_url, use_column_width=True)
-                        title = video['snippet']['title']
-                        st.markdown(f"**{title[:50]}{'...' if len(title) > 50 else ''}**")
-                        st.write(f"Published: {video['snippet']['publishedAt'][:10]}")
-                        if st.button(f"Play Video {i+j+1}"):
-                            video_id = video['id']['videoId']
-                            video_placeholder.markdown(f'<iframe width="100%" height="315" src="https://www.youtube.com/embed/{video_id}" frameborder="0" allowfullscreen></iframe>', unsafe_allow_html=True)
+    # Filtering happens outside the cache so changing keywords doesn't refetch
+    videos = filter_relevant_content(get_cached_videos(channels, max_results, quota_generation()), keywords)
+    if quota_tripped():
+        st.error(f"YouTube API quota exceeded, showing cached videos only: {get_quota_state()['error']}")
+
+    render_video_grid(videos)
 
 if __name__ == "__main__":
     main()